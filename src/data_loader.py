@@ -1,4 +1,7 @@
-from typing import Any, List
+import queue
+import threading
+from functools import partial
+from typing import Any, Iterable, Iterator, List
 
 import jax
 import numpy as np
@@ -8,7 +11,13 @@ from torch.utils import data
 class DataLoader(data.DataLoader):
     """PyTorch data loader with jax-compatible collate function."""
 
-    def __init__(self, dataset: data.Dataset, batch_size: int, sampler: data.Sampler):
+    def __init__(
+        self,
+        dataset: data.Dataset,
+        batch_size: int,
+        sampler: data.Sampler,
+        pad_last_batch: bool = False,
+    ):
         """
         Initializes data loader.
 
@@ -16,27 +25,85 @@ class DataLoader(data.DataLoader):
             dataset (data.Dataset): Dataset.
             batch_size (int): Batch size.
             sampler (data.Sampler): Data sampler.
+            pad_last_batch (bool, optional): Pads the final batch to the full batch size
+                and appends a validity mask to every batch, such that all batches have
+                static shapes and jitted consumers are not re-traced. Defaults to False.
         """
 
         super().__init__(
             dataset,
             batch_size=batch_size,
             num_workers=0,
-            collate_fn=self.collate_fn,
+            collate_fn=partial(self.collate_fn, pad_to=batch_size if pad_last_batch else None),
             sampler=sampler,
         )
 
     @staticmethod
-    def collate_fn(batch: List[Any]) -> jax.Array:
+    def collate_fn(batch: List[Any], pad_to: int | None = None) -> jax.Array:
         """
         Collate function, mapping a list of PyTorch batch items to a numpy array.
         cf. https://jax.readthedocs.io/en/latest/notebooks/Neural_Network_and_Data_Loading.html#data-loading-with-pytorch
 
         Args:
             batch (List[Any]): List of PyTorch batch items.
+            pad_to (int | None, optional): If set, pads the batch with zero items up to
+                this size and additionally returns a validity mask. Defaults to None.
 
         Returns:
             jax.Array: Array with batch items stacked along a new dimension.
         """
 
-        return jax.tree_map(np.asarray, data.default_collate(batch))
+        collated = jax.tree_map(np.asarray, data.default_collate(batch))
+
+        if pad_to is None:
+            return collated
+
+        x, y = collated
+        N = y.shape[0]
+        mask = np.zeros((pad_to,), dtype=int)  # [N_pad]
+        mask[:N] = 1
+        if N < pad_to:
+            x = np.concatenate((x, np.zeros((pad_to - N, *x.shape[1:]), dtype=x.dtype)))
+            y = np.concatenate((y, np.zeros((pad_to - N,), dtype=y.dtype)))
+        return x, y, mask  # type: ignore
+
+
+def prefetch_to_device(
+    iterable: Iterable[Any], size: int = 2, device: Any | None = None
+) -> Iterator[Any]:
+    """
+    Iterates over batches on a background thread and moves them to device ahead of time,
+    such that the host-to-device transfer of the next batch overlaps with the
+    computation on the current one (double-buffering for size=2).
+
+    Args:
+        iterable (Iterable[Any]): Iterable over batches (pytrees of arrays).
+        size (int, optional): Number of prefetched batches. Defaults to 2.
+        device (Any | None, optional): Target device. Defaults to None (default device).
+
+    Yields:
+        Iterator[Any]: Iterator over batches, already placed on device.
+    """
+
+    buffer: queue.Queue = queue.Queue(maxsize=size)
+    sentinel = object()
+
+    def worker() -> None:
+        # Exceptions are passed through the queue and re-raised on the consuming
+        # thread, such that a data-loading error surfaces as a traceback there
+        # instead of a silent hang on an empty queue
+        try:
+            for batch in iterable:
+                buffer.put(jax.device_put(batch, device))
+        except Exception as e:
+            buffer.put(e)
+        else:
+            buffer.put(sentinel)
+
+    # Daemon thread: does not keep the process alive if iteration is abandoned early
+    threading.Thread(target=worker, daemon=True).start()
+
+    while (batch := buffer.get()) is not sentinel:
+        if isinstance(batch, Exception):
+            raise batch
+        yield batch
@@ -1,17 +1,19 @@
-from functools import partial
+from functools import lru_cache, partial
 from typing import Any, List, Tuple
 
 import jax
 import jax.flatten_util
 import jax.numpy as jnp
 import jax.scipy as jsp
+import numpy as np
 import optax
 from flax.core.frozen_dict import FrozenDict
 from flax.training.train_state import TrainState
-from jax import tree_util
+from jax.experimental.shard_map import shard_map
+from jax.sharding import Mesh, PartitionSpec
 from tqdm import tqdm
 
-from data_loader import DataLoader
+from data_loader import DataLoader, prefetch_to_device
 from log_utils import (
     get_save_measure,
     load_ggn,
@@ -22,6 +24,31 @@ from log_utils import (
 )
 from sampler import WeightedSampler
 
+# Maximum number of data batches whose GGN computation is fused into a single vmapped
+# jit call. Bounds the memory of the vmapped [K, N, C, D] Jacobian while still
+# amortizing kernel launches across batches.
+GGN_GROUP_SIZE = 8
+
+
+@lru_cache(maxsize=None)
+def get_einsum_path(subscripts: str, *shapes: Tuple[int, ...]) -> List[Any]:
+    """
+    Computes the optimal contraction path for an einsum expression once per
+    (subscripts, shapes) combination and caches it, such that repeated traces of the
+    jitted callers do not redo the path search.
+
+    Args:
+        subscripts (str): Einsum subscripts.
+        *shapes (Tuple[int, ...]): Shapes of the einsum operands.
+
+    Returns:
+        List[Any]: Contraction path, passable as 'optimize' argument to jnp.einsum.
+    """
+
+    # Zero-strided dummy operands: no memory allocation needed for the path search
+    operands = [np.broadcast_to(np.float32(0.0), shape) for shape in shapes]
+    return jnp.einsum_path(subscripts, *operands, optimize="optimal")[0]
+
 
 @jax.jit
 def compute_ggn_decomp(
@@ -44,20 +71,24 @@ def compute_ggn_decomp(
             per-item H_loss ([N, C, C]).
     """
 
-    def model_fn(params: FrozenDict[str, Any], x: jax.Array) -> jax.Array:
+    def model_fn_single(
+        params: FrozenDict[str, Any], x: jax.Array
+    ) -> Tuple[jax.Array, jax.Array]:
         """
-        Performs model forward pass as a function of model parameters.
+        Performs model forward pass for a single data item as a function of model parameters.
+        The logits are returned twice: as differentiated output and as auxiliary output,
+        such that jacrev shares the forward pass instead of recomputing it.
 
         Args:
             params (FrozenDict[str, Any]): Model parameters ([D], pytree in D).
-            x (jax.Array): Model input ([N, ...]).
+            x (jax.Array): Single model input ([...]).
 
         Returns:
-            jax.Array: Model output ([N, C]).
+            Tuple[jax.Array, jax.Array]: Single model output ([C]), twice.
         """
 
-        logits = state.apply_fn(params, x)  # [N, C]
-        return logits
+        logits = state.apply_fn(params, x[None, ...])[0]  # [C]
+        return logits, logits
 
     def loss_fn(logits: jax.Array, y: jax.Array) -> jax.Array:
         """
@@ -77,32 +108,129 @@ def compute_ggn_decomp(
     # Retrieve data
     x, y = batch
 
-    # Forward pass
-    logits = model_fn(state.params, x)  # [N, C]
-    N, C = logits.shape
-
     # Define differentiating functions:
     #   - 'J_model_fn': Jacobian of model output w.r.t. model parameters
     #   - 'd_loss_fn': Gradient of loss w.r.t. model output
     #   - 'H_loss_fn': Hessian of loss w.r.t. model output
-    J_model_fn = jax.jacrev(model_fn)  # [D]->[C, D], D>>C
+    # The Jacobian is computed per item and vmapped over the batch dim, which tiles the
+    # C reverse passes per example instead of running jacrev on the whole batch at once.
+    # The forward pass is rematerialized (keeping only matmul outputs), such that the
+    # reverse passes do not need to store every pointwise activation
+    model_fn_remat = jax.checkpoint(
+        model_fn_single, policy=jax.checkpoint_policies.dots_with_no_batch_dims_saveable
+    )
+    J_model_fn = jax.vmap(
+        jax.jacrev(model_fn_remat, has_aux=True), in_axes=(None, 0)
+    )  # [D]->[C, D], D>>C
     d_loss_fn = jax.grad(loss_fn)  # [C]->[C]
     H_loss_fn = jax.jacfwd(d_loss_fn)  # [C]->[C, C]
 
     # Compute differential quantities:
     #   - 'J_model': Per-item Jacobian of model output w.r.t. model parameters
+    #   - 'logits': Per-item model output, shared with the Jacobian's forward pass
     #   - 'H_loss': Per-item Hessian of loss w.r.t. model output
-    J_model = J_model_fn(state.params, x)  # [N, C, D], pytree in D
+    J_model, logits = J_model_fn(state.params, x)  # [N, C, D], pytree in D; [N, C]
     H_loss = jax.vmap(H_loss_fn)(logits, y)  # [N, C, C]
 
-    # Transform 'J_model' from pytree representation into vector representation
-    J_model = jnp.concatenate(
-        [x.reshape(N, C, -1) for x in tree_util.tree_leaves(J_model)], axis=2
+    # Transform 'J_model' from pytree representation into vector representation via a
+    # single per-row ravel instead of a reshape+concatenate over all leaves
+    J_model = jax.vmap(jax.vmap(lambda tree: jax.flatten_util.ravel_pytree(tree)[0]))(
+        J_model
     )  # [N, C, D]
 
     return logits, J_model, H_loss
 
 
+@jax.jit
+def compute_ggn_mvp(
+    state: TrainState, batch: Tuple[jax.Array, jax.Array], v: jax.Array
+) -> jax.Array:
+    """
+    Computes per-item GGN-vector products J_model.T @ H_loss @ J_model @ v lazily via
+    JVP/VJP, without materializing J_model ([N, C, D]) or the GGN ([N, D, D]).
+    Only [N, C]-sized intermediates are kept, which reduces peak memory from O(N*D^2)
+    to O(N*C) whenever downstream computations only require GGN-vector products.
+    C: Model output dim.
+    D: Parameter dim.
+    N: Batch dim.
+
+    Args:
+        state (TrainState): Current training state.
+        batch (Tuple[jax.Array, jax.Array]): Batched input data.
+        v (jax.Array): Vector to multiply with ([D]).
+
+    Returns:
+        jax.Array: Per-item GGN-vector product ([N, D]).
+    """
+
+    def model_fn(params: FrozenDict[str, Any], x: jax.Array) -> jax.Array:
+        """
+        Performs model forward pass for a single data item as a function of model parameters.
+
+        Args:
+            params (FrozenDict[str, Any]): Model parameters ([D], pytree in D).
+            x (jax.Array): Single model input ([...]).
+
+        Returns:
+            jax.Array: Single model output ([C]).
+        """
+
+        logits = state.apply_fn(params, x[None, ...])[0]  # [C]
+        return logits
+
+    def loss_fn(logits: jax.Array, y: jax.Array) -> jax.Array:
+        """
+        Computes loss for a single data item as a function of model output.
+
+        Args:
+            logits (jax.Array): Single model output ([C]).
+            y (jax.Array): Single ground truth, integer-encoded ([]).
+
+        Returns:
+            jax.Array: Loss ([]).
+        """
+
+        loss = optax.softmax_cross_entropy_with_integer_labels(logits, y)  # []
+        return loss  # type: ignore
+
+    # Retrieve data
+    x, y = batch
+
+    # Hessian of loss w.r.t. model output: [C]->[C, C]
+    H_loss_fn = jax.jacfwd(jax.grad(loss_fn))
+
+    # Transform 'v' from vector representation into pytree representation
+    unravel_fn = jax.flatten_util.ravel_pytree(state.params)[1]
+    v_pytree = unravel_fn(v)  # [D], pytree in D
+
+    def mvp_fn(x_single: jax.Array, y_single: jax.Array) -> jax.Array:
+        """
+        Computes GGN-vector product for a single data item.
+
+        Args:
+            x_single (jax.Array): Single model input ([...]).
+            y_single (jax.Array): Single ground truth, integer-encoded ([]).
+
+        Returns:
+            jax.Array: GGN-vector product ([D]).
+        """
+
+        # J_model @ v via JVP, reusing the forward pass for the logits
+        logits, Jv = jax.jvp(
+            lambda params: model_fn(params, x_single), (state.params,), (v_pytree,)
+        )  # [C]; [C]
+        # H_loss @ (J_model @ v)
+        HJv = H_loss_fn(logits, y_single) @ Jv  # [C]
+        # J_model.T @ (H_loss @ J_model @ v) via VJP
+        vjp_fn = jax.vjp(lambda params: model_fn(params, x_single), state.params)[1]
+        (JtHJv,) = vjp_fn(HJv)  # [D], pytree in D
+
+        # Transform result from pytree representation into vector representation
+        return jax.flatten_util.ravel_pytree(JtHJv)[0]  # [D]
+
+    return jax.vmap(mvp_fn)(x, y)  # [N, D]
+
+
 def compute_ggn(J_model: jax.Array, H_loss: jax.Array) -> jax.Array:
     """
     Computes GGN realization as product of Jacobians and Hessian.
@@ -118,8 +246,163 @@ def compute_ggn(J_model: jax.Array, H_loss: jax.Array) -> jax.Array:
         jax.Array: Per-item GGN ([N, D, D]).
     """
 
-    # Compute per-item Generalized Gauss-Newton (GGN) matrix: J_model.T @ H_loss @ J_model
-    return jnp.einsum("nax,nab,nby->nxy", J_model, H_loss, J_model)  # [N, D, D]
+    # Factorize per-item H_loss = L @ L.T via its eigendecomposition (C is small, so this
+    # is cheap compared to any J_model-touching contraction)
+    eigval, eigvec = jnp.linalg.eigh(H_loss)  # [N, C]; [N, C, C]
+    L = eigvec * jnp.sqrt(jnp.clip(eigval, a_min=0.0))[..., None, :]  # [N, C, C]
+
+    # Compute per-item Generalized Gauss-Newton (GGN) matrix as symmetric product
+    # (L.T @ J_model).T @ (L.T @ J_model), touching J_model only once.
+    # The gemms run at TF32 precision: the GGN is only used in sample-averaged
+    # approximations, whose sampling error dominates the reduced mantissa
+    with jax.default_matmul_precision("tensorfloat32"):
+        M = jnp.einsum(
+            "nca,ncx->nax",
+            L,
+            J_model,
+            optimize=get_einsum_path("nca,ncx->nax", L.shape, J_model.shape),
+        )  # [N, C, D]
+        return jnp.einsum(
+            "nax,nay->nxy", M, M, optimize=get_einsum_path("nax,nay->nxy", M.shape, M.shape)
+        )  # [N, D, D]
+
+
+def compute_ggn_group(J_model: jax.Array, H_loss: jax.Array) -> jax.Array:
+    """
+    Computes group-summed per-item GGN realization over a group of K batches.
+    The group dim is summed inside the contraction, such that per-item GGNs are
+    materialized once per group instead of once per batch.
+    C: Model output dim.
+    D: Parameter dim.
+    K: Batch group dim.
+    N: Batch dim.
+
+    Args:
+        J_model (jax.Array): Per-item J_model ([K, N, C, D]).
+        H_loss (jax.Array): Per-item H_loss ([K, N, C, C]).
+
+    Returns:
+        jax.Array: Group-summed per-item GGN ([N, D, D]).
+    """
+
+    # Factorize per-item H_loss = L @ L.T via its eigendecomposition (cf. compute_ggn)
+    eigval, eigvec = jnp.linalg.eigh(H_loss)  # [K, N, C]; [K, N, C, C]
+    L = eigvec * jnp.sqrt(jnp.clip(eigval, a_min=0.0))[..., None, :]  # [K, N, C, C]
+
+    # Compute group-summed per-item GGN with the group dim contracted away
+    # (TF32 gemms, cf. compute_ggn)
+    with jax.default_matmul_precision("tensorfloat32"):
+        M = jnp.einsum(
+            "knca,kncx->knax",
+            L,
+            J_model,
+            optimize=get_einsum_path("knca,kncx->knax", L.shape, J_model.shape),
+        )  # [K, N, C, D]
+        return jnp.einsum(
+            "knax,knay->nxy", M, M, optimize=get_einsum_path("knax,knay->nxy", M.shape, M.shape)
+        )  # [N, D, D]
+
+
+def compute_ggn_total(J_model: jax.Array, H_loss: jax.Array) -> jax.Array:
+    """
+    Computes batch-summed GGN realization as product of Jacobians and Hessian.
+    In contrast to compute_ggn, the batch dim is summed inside the contraction, such
+    that only the [D, D] result is materialized instead of per-item [N, D, D] GGNs.
+    C: Model output dim.
+    D: Parameter dim.
+    N: Batch dim.
+
+    Args:
+        J_model (jax.Array): Per-item J_model ([N, C, D]).
+        H_loss (jax.Array): Per-item H_loss ([N, C, C]).
+
+    Returns:
+        jax.Array: Batch-summed GGN ([D, D]).
+    """
+
+    # Factorize per-item H_loss = L @ L.T via its eigendecomposition (cf. compute_ggn)
+    eigval, eigvec = jnp.linalg.eigh(H_loss)  # [N, C]; [N, C, C]
+    L = eigvec * jnp.sqrt(jnp.clip(eigval, a_min=0.0))[..., None, :]  # [N, C, C]
+
+    # Compute batch-summed GGN with the batch dim contracted away
+    # (TF32 gemms, cf. compute_ggn)
+    with jax.default_matmul_precision("tensorfloat32"):
+        M = jnp.einsum(
+            "nca,ncx->nax",
+            L,
+            J_model,
+            optimize=get_einsum_path("nca,ncx->nax", L.shape, J_model.shape),
+        )  # [N, C, D]
+        return jnp.einsum(
+            "nax,nay->xy", M, M, optimize=get_einsum_path("nax,nay->xy", M.shape, M.shape)
+        )  # [D, D]
+
+
+def compute_ggn_total_scan(
+    state: TrainState, batches: Tuple[jax.Array, jax.Array]
+) -> jax.Array:
+    """
+    Computes the summed GGN over a stack of batches via lax.scan within a single jitted
+    computation. Only the [D, D] running sum is carried across batches, such that XLA
+    fuses the whole sweep into one program without per-batch dispatch overhead.
+    B: Number of batches.
+    C: Model output dim.
+    D: Parameter dim.
+    N: Batch dim.
+
+    Args:
+        state (TrainState): Current training state.
+        batches (Tuple[jax.Array, jax.Array]): Stacked batched input data ([B, N, ...]).
+
+    Returns:
+        jax.Array: Summed GGN over all batches ([D, D]).
+    """
+
+    D = jax.flatten_util.ravel_pytree(state.params)[0].shape[0]
+
+    def scan_fn(
+        GGN_sum: jax.Array, batch: Tuple[jax.Array, jax.Array]
+    ) -> Tuple[jax.Array, None]:
+        _, J_model, H_loss = compute_ggn_decomp(state, batch)  # [N, C, D], [N, C, C]
+        return GGN_sum + compute_ggn_total(J_model, H_loss), None
+
+    GGN_sum, _ = jax.lax.scan(scan_fn, jnp.zeros((D, D)), batches)  # [D, D]
+
+    return GGN_sum
+
+
+def compute_ggn_total_scan_sharded(
+    state: TrainState, batches: Tuple[jax.Array, jax.Array]
+) -> jax.Array:
+    """
+    Computes the summed GGN over a stack of batches like compute_ggn_total_scan, with
+    the stacked-batch dim sharded across all available devices. The GGN is
+    embarrassingly data-parallel over batches, so each device scans its shard of B
+    batches into a partial [D, D] sum, which is all-reduced at the end. Requires the
+    stacked-batch dim B to be divisible by the number of devices.
+    B: Number of batches.
+    C: Model output dim.
+    D: Parameter dim.
+    N: Batch dim.
+
+    Args:
+        state (TrainState): Current training state.
+        batches (Tuple[jax.Array, jax.Array]): Stacked batched input data ([B, N, ...]).
+
+    Returns:
+        jax.Array: Summed GGN over all batches ([D, D]).
+    """
+
+    mesh = Mesh(np.asarray(jax.devices()), ("batch",))
+
+    sharded_fn = shard_map(
+        lambda state, batches: jax.lax.psum(compute_ggn_total_scan(state, batches), "batch"),
+        mesh=mesh,
+        in_specs=(PartitionSpec(), PartitionSpec("batch")),
+        out_specs=PartitionSpec(),
+    )
+
+    return sharded_fn(state, batches)
 
 
 def compute_ggn_inv(GGN: jax.Array, prior_precision: float) -> jax.Array:
@@ -158,7 +441,15 @@ def compute_ltk(J_infer: jax.Array, GGN_inv: jax.Array) -> jax.Array:
     """
 
     # Compute LTK as simple matrix product: J_infer @ GGN_inv @ J_infer.T
-    return jnp.einsum("mai,nij,mbj->nmab", J_infer, GGN_inv, J_infer)  # [N, M, C, C]
+    return jnp.einsum(
+        "mai,nij,mbj->nmab",
+        J_infer,
+        GGN_inv,
+        J_infer,
+        optimize=get_einsum_path(
+            "mai,nij,mbj->nmab", J_infer.shape, GGN_inv.shape, J_infer.shape
+        ),
+    )  # [N, M, C, C]
 
 
 @jax.jit
@@ -184,47 +475,22 @@ def compute_predictive_distribution(y_infer: jax.Array, LTK: jax.Array) -> jax.A
     )  # [N, M, C]
 
 
-def aggregate_samples(
-    average: jax.Array, samples: jax.Array, aggregated_sample_size: int
-) -> jax.Array:
+def accumulate_samples(accumulator: jax.Array, samples: jax.Array) -> jax.Array:
     """
-    Aggregates samples as moving average.
-    N: Batch dim.
+    Accumulates summed samples as running sum. In contrast to a moving average, this
+    touches the accumulator only once per update; the division by the sample size is
+    deferred to the (few) write-out points.
 
     Args:
-        average (jax.Array): Previous moving average ([N, ...]).
-        samples (jax.Array): New samples ([N, ...]).
-        aggregated_sample_size (int): Sample size after aggregation.
+        accumulator (jax.Array): Previous running sum ([...]).
+        samples (jax.Array): New summed samples ([...]).
 
     Returns:
-        jax.Array: Aggregated moving average ([N, ...]).
+        jax.Array: Updated running sum ([...]).
     """
 
-    # Aggregates samples as moving average
-    return average + (samples - average) / aggregated_sample_size  # [N, ...]
-
-
-def aggregate_samples_total(
-    average_total: jax.Array, samples: jax.Array, aggregated_sample_size: int
-) -> jax.Array:
-    """
-    Aggregates total samples as moving average.
-    N: Batch dim.
-
-    Args:
-        average_total (jax.Array): Previous total moving average ([...]).
-        samples (jax.Array): New samples ([N, ...]).
-        aggregated_sample_size (int): Total sample size after aggregation.
-
-    Returns:
-        jax.Array: Aggregated total moving average ([...]).
-    """
-
-    # Aggregates samples as total moving average
-    return (
-        average_total
-        + jnp.sum(samples - average_total[None, ...], axis=0) / aggregated_sample_size
-    )  # [...]
+    # Accumulates summed samples as running sum
+    return accumulator + samples  # [...]
 
 
 def start_experiment(
@@ -234,6 +500,7 @@ def start_experiment(
     test_dataloader: DataLoader,
     ggn_sample_sizes: List[int],
     prior_precision: float,
+    ggn_dtype: str,
     experiment_name: str,
     n_steps: int,
     compose_on_cpu: bool,
@@ -250,6 +517,7 @@ def start_experiment(
         test_dataloader (DataLoader): Dataloader for Laplace approximation.
         ggn_sample_sizes (List[int]): Sample sizes for sample-approximate GGNs.
         prior_precision (float): Prior precision used for Laplace approximation.
+        ggn_dtype (str): Dtype for GGN samples storage and accumulation.
         experiment_name (str): Name of the experiment.
         n_steps (int): Number of completed training steps across epochs.
         compose_on_cpu (bool): Whether GGN realization should be computed on CPU.
@@ -257,6 +525,11 @@ def start_experiment(
         results_path (str): Results path.
     """
 
+    # GGN samples dominate memory bandwidth at [N, D, D]; accumulating them in a
+    # reduced-precision dtype (bfloat16/float16) halves it. The total GGN stays in
+    # float32, and samples are upcast once at each write-out point.
+    ggn_dtype = jnp.dtype(ggn_dtype)  # type: ignore
+
     if experiment_name == "laplace":
         save_measure = None
     else:
@@ -277,9 +550,12 @@ def start_experiment(
     # Compute GGN realization on CPU, if needed
     device = jax.devices("cpu")[0] if compose_on_cpu else None
     device_cpu = jax.devices("cpu")[0]
-    compute_ggn_jit = jax.jit(compute_ggn, device=device)
-    aggregate_ggn_jit = jax.jit(aggregate_samples, device=device)
-    aggregate_ggn_total_jit = jax.jit(aggregate_samples_total, device=device)
+    compute_ggn_decomp_vmap = jax.vmap(compute_ggn_decomp, in_axes=(None, 0))
+    compute_ggn_group_jit = jax.jit(compute_ggn_group, device=device)
+    compute_ggn_total_jit = jax.jit(compute_ggn_total, device=device)
+    compute_ggn_total_scan_jit = jax.jit(compute_ggn_total_scan, device=device)
+    compute_ggn_total_scan_sharded_jit = jax.jit(compute_ggn_total_scan_sharded)
+    accumulate_ggn_jit = jax.jit(accumulate_samples, device=device)
     compute_ggn_inv_jit = jax.vmap(
         jax.jit(partial(compute_ggn_inv, prior_precision=prior_precision), device=device)
     )
@@ -288,35 +564,46 @@ def start_experiment(
     if isinstance(sample_dataloader.sampler, WeightedSampler):
         sample_dataloader.sampler.update(state)
 
-    # Iterate over dataset for GGN samples computation
+    # Iterate over dataset for GGN samples computation, fusing groups of up to
+    # GGN_GROUP_SIZE batches into single vmapped GGN computations
+    batch_group = []
     for ggn_step_idx, ggn_batch in enumerate(
         tqdm(
-            sample_dataloader,
+            prefetch_to_device(sample_dataloader),
+            total=len(sample_dataloader),
             desc="GGN-sample-step",
             disable=no_progress_bar,
         )
     ):
-        # Compute GGN samples
-        _, J_model, H_loss = compute_ggn_decomp(state, ggn_batch)  # [N, C, D], [N, C, C]
+        batch_group.append(ggn_batch)
+        aggregated_sample_size = ggn_step_idx + 1
+        # Defer computation until the group is complete or a checkpoint is reached
+        if len(batch_group) < GGN_GROUP_SIZE and aggregated_sample_size not in ggn_sample_sizes:
+            continue
+
+        # Compute group-averaged GGN samples
+        batches = jax.tree_map(lambda *xs: jnp.stack(xs), *batch_group)  # [K, N, ...]
+        _, J_model, H_loss = compute_ggn_decomp_vmap(state, batches)  # [K, N, C, D], [K, N, C, C]
         if compose_on_cpu:
             J_model = jax.device_put(J_model, jax.devices('cpu')[0])
             H_loss = jax.device_put(H_loss, jax.devices('cpu')[0])
-        GGN = compute_ggn_jit(J_model, H_loss)  # [N, D, D]
+        GGN = compute_ggn_group_jit(J_model, H_loss).astype(ggn_dtype)  # [N, D, D]
 
-        # Aggregate GGN samples as running average to save memory
-        aggregated_sample_size = ggn_step_idx + 1
+        # Accumulate GGN samples as running sum; the division by the sample size is
+        # deferred to the write-out points below
+        batch_group = []
         if GGN_samples is None:
             GGN_samples = GGN.copy()  # [N, D, D]
         else:
-            GGN_samples = aggregate_ggn_jit(GGN_samples, GGN, aggregated_sample_size)  # [N, D, D]
+            GGN_samples = accumulate_ggn_jit(GGN_samples, GGN)  # [N, D, D]
 
         # Save GGN samples on disk, if needed aggregated sample size reached
         if aggregated_sample_size in ggn_sample_sizes:
             ggn_sample_size_idx = ggn_sample_sizes.index(aggregated_sample_size)
 
-            # Save GGN samples
+            # Save GGN samples (divide and upcast once at write-out)
             save_ggn(
-                GGN_samples,
+                (GGN_samples / aggregated_sample_size).astype(jnp.float32),
                 n_steps,
                 results_path,
                 sample_size=aggregated_sample_size,
@@ -327,7 +614,8 @@ def start_experiment(
                 GGN_samples = None
                 break
 
-    # Iterate over dataset for GGN total computation
+    # Collect dataset batches for GGN total computation
+    ggn_batches = []
     for ggn_step_idx, ggn_batch in enumerate(
         tqdm(
             total_dataloader,
@@ -339,19 +627,30 @@ def start_experiment(
         if ggn_step_idx >= 8:
             break
 
-        # Compute GGN samples
-        _, J_model, H_loss = compute_ggn_decomp(state, ggn_batch)  # [N, C, D], [N, C, C]
-        if compose_on_cpu:
-            J_model = jax.device_put(J_model, jax.devices('cpu')[0])
-            H_loss = jax.device_put(H_loss, jax.devices('cpu')[0])
-        GGN = compute_ggn_jit(J_model, H_loss)  # [N, D, D]
-
-        # Compute total GGN as running average to save memory
-        GGN_counter += GGN.shape[0]
-        if GGN_total is None:
-            GGN_total = jnp.mean(GGN, axis=0)  # [D, D]
-        else:
-            GGN_total = aggregate_ggn_total_jit(GGN_total, GGN, GGN_counter)  # [D, D]
+        ggn_batches.append(ggn_batch)
+
+    # Split off a final smaller batch, since lax.scan requires equally-sized batches
+    ggn_batch_last = None
+    if len(ggn_batches) > 1 and ggn_batches[-1][0].shape[0] != ggn_batches[0][0].shape[0]:
+        ggn_batch_last = ggn_batches.pop()
+
+    # Compute total GGN over all batches within a single jitted lax.scan, carrying only
+    # the [D, D] running sum and never materializing per-item [N, D, D] GGNs
+    batches = jax.tree_map(lambda *xs: jnp.stack(xs), *ggn_batches)  # [B, N, ...]
+    GGN_counter = len(ggn_batches) * ggn_batches[0][0].shape[0]
+    # Shard the scan over batches across devices, if possible (each device computes a
+    # partial [D, D] sum over its shard, all-reduced at the end)
+    if not compose_on_cpu and jax.device_count() > 1 and len(ggn_batches) % jax.device_count() == 0:
+        GGN_total = compute_ggn_total_scan_sharded_jit(state, batches)  # [D, D]
+    else:
+        GGN_total = compute_ggn_total_scan_jit(state, batches)  # [D, D]
+    if ggn_batch_last is not None:
+        _, J_model, H_loss = compute_ggn_decomp(state, ggn_batch_last)
+        GGN_total = accumulate_ggn_jit(GGN_total, compute_ggn_total_jit(J_model, H_loss))
+        GGN_counter += ggn_batch_last[0].shape[0]
+
+    # Realize total GGN as average over all accumulated per-item GGNs
+    GGN_total = GGN_total / GGN_counter  # [D, D]
 
     # Compute and save measure, then remove GGN
     if save_measure is not None:
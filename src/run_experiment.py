@@ -49,6 +49,13 @@ def main() -> None:
         default=8,
         help="Number of independent samples per experiment.",
     )
+    parser.add_argument(
+        "--ggn-dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "bfloat16", "float16"],
+        help="Dtype for GGN samples storage and accumulation.",
+    )
     parser.add_argument(
         "--prior-precision",
         type=float,
@@ -132,6 +139,7 @@ def main() -> None:
         test_dataloader,
         ggn_sample_sizes,
         args.prior_precision,
+        args.ggn_dtype,
         args.experiment,
         args.checkpoint_step,
         args.compose_on_cpu,
@@ -29,6 +29,12 @@ def main() -> None:
     )
     parser.add_argument("--lr", type=int, default=1e-3, help="Learning rate.")
     parser.add_argument("--epochs", type=int, default=5, help="Number of training epochs.")
+    parser.add_argument(
+        "--n-jitted-steps",
+        type=int,
+        default=1,
+        help="Number of training steps jitted together to amortize dispatch overhead.",
+    )
     parser.add_argument("--rng-seed", type=int, default=7, help="RNG seed.")
     parser.add_argument("--data-path", type=str, default="../data/", help="Data path.")
     parser.add_argument(
@@ -71,8 +77,14 @@ def main() -> None:
         args.no_progress_bar,
     )
 
-    train_dataloader = DataLoader(train_dataset, args.train_batch_size, train_sampler)
-    test_dataloader = DataLoader(test_dataset, args.train_batch_size, test_sampler)
+    # Pad the final batch to keep batch shapes static across steps (avoids re-tracing
+    # the jitted train/test steps once per epoch)
+    train_dataloader = DataLoader(
+        train_dataset, args.train_batch_size, train_sampler, pad_last_batch=True
+    )
+    test_dataloader = DataLoader(
+        test_dataset, args.train_batch_size, test_sampler, pad_last_batch=True
+    )
 
     # Setup model
     model = get_model(args.dataset, args.hidden_dim)
@@ -107,6 +119,7 @@ def main() -> None:
             train_state,
             train_dataloader,
             n_steps,
+            args.n_jitted_steps,
             args.no_progress_bar,
             checkpoint_manager,
         )
@@ -1,4 +1,3 @@
-from functools import partial
 from typing import Any, Tuple
 
 import jax
@@ -8,12 +7,15 @@ from flax.core.frozen_dict import FrozenDict
 from flax.training import orbax_utils
 from flax.training.train_state import TrainState
 from jax import numpy as jnp
-from jax import tree_util
 from orbax.checkpoint import CheckpointManager
 from tqdm import tqdm
 
 from data_loader import DataLoader
 
+# Interval (in training/test steps) between progress-bar statistics updates. Formatting
+# the statistics forces a device-to-host sync, so it is only done every few steps.
+PBAR_STATS_INTERVAL = 50
+
 
 def train_step(
     state: TrainState,
@@ -39,11 +41,17 @@ def train_step(
             number of ground-truth items per class ([C]).
     """
 
+    # Retrieve data (with validity mask, if the data loader pads the final batch)
+    x, y, *rest = batch
+    mask = rest[0] if rest else jnp.ones_like(y)  # [N]
+
     def model_loss_fn(
         params: FrozenDict[str, Any], x: jax.Array, y: jax.Array
     ) -> Tuple[jax.Array, Tuple[jax.Array, jax.Array]]:
         """
         Performs model forward pass and evaluates mean loss as a function of model parameters.
+        The top-1 correctness indicator is folded into the auxiliary output, such that it
+        shares the logits with the loss instead of requiring a separate pass.
 
         Args:
             params (FrozenDict[str, Any]): Model parameters ([D], pytree in D).
@@ -54,31 +62,28 @@ def train_step(
             Tuple[jax.Array, Tuple[jax.Array, jax.Array]]:
                 Mean loss ([1]),
                 per-item loss ([N]),
-                model output ([N, C]).
+                per-item correctness indicator ([N]).
         """
 
         logits = state.apply_fn(params, x)  # [N, C]
-        loss_unreduced = optax.softmax_cross_entropy_with_integer_labels(logits, y)  # [N]
-        loss = jnp.mean(loss_unreduced)  # [1]
-        return loss, (loss_unreduced, logits)  # type: ignore
-
-    # Retrieve data
-    x, y = batch
+        loss_unreduced = mask * optax.softmax_cross_entropy_with_integer_labels(logits, y)  # [N]
+        loss = jnp.sum(loss_unreduced) / jnp.sum(mask)  # [1]
+        correct = (jnp.argmax(logits, -1) == y).astype(int) * mask  # [N]
+        return loss, (loss_unreduced, correct)  # type: ignore
 
     # Forward pass + gradient
-    (_, (loss, logits)), d_loss = jax.value_and_grad(model_loss_fn, has_aux=True)(
+    (_, (loss, correct)), d_loss = jax.value_and_grad(model_loss_fn, has_aux=True)(
         state.params, x, y
-    )  # [N]; [N, C]; [D], pytree in D
+    )  # [N]; [N]; [D], pytree in D
 
     # Compute number of correct predictions per class
-    correct = (jnp.argmax(logits, -1) == y).astype(int)  # [N]
     # Add dummy false predictions to account for every class
     y_dummy = jnp.concatenate((y, jnp.arange(n_classes, dtype=int)))  # [N+C]
     correct_dummy = jnp.concatenate((correct, jnp.zeros((n_classes,), dtype=int)))  # [N+C]
     n_correct_per_class = jnp.bincount(y_dummy, correct_dummy, length=n_classes)  # [C]
     n_per_class = jnp.bincount(
         y_dummy,
-        jnp.concatenate((jnp.ones_like(y), jnp.zeros((n_classes,), dtype=int))),
+        jnp.concatenate((mask, jnp.zeros((n_classes,), dtype=int))),
         length=n_classes,
     )  # [C]
 
@@ -88,6 +93,52 @@ def train_step(
     return state, loss, n_correct_per_class, n_per_class
 
 
+def train_multi_step(
+    state: TrainState,
+    batches: Tuple[jax.Array, jax.Array],
+    n_classes: int,
+) -> Tuple[TrainState, jax.Array, jax.Array, jax.Array]:
+    """
+    Performs multiple training steps inside a single jitted computation via lax.scan,
+    amortizing the host dispatch overhead of one jit call over K steps.
+    C: Model output dim.
+    K: Number of scanned training steps.
+    N: Batch dim.
+
+    Args:
+        state (TrainState): Current training state.
+        batches (Tuple[jax.Array, jax.Array]): Stacked batched input data ([K, N, ...]).
+        n_classes (int): Number of classes (equal to C).
+
+    Returns:
+        Tuple[TrainState, jax.Array, jax.Array, jax.Array]:
+            Updated training state,
+            per-item loss ([K, N]),
+            number of correct predictions per class ([K, C]),
+            number of ground-truth items per class ([K, C]).
+    """
+
+    def scan_fn(
+        state: TrainState, batch: Tuple[jax.Array, jax.Array]
+    ) -> Tuple[TrainState, Tuple[jax.Array, jax.Array, jax.Array]]:
+        state, loss, n_correct_per_class, n_per_class = train_step(state, batch, n_classes)
+        return state, (loss, n_correct_per_class, n_per_class)
+
+    state, (loss, n_correct_per_class, n_per_class) = jax.lax.scan(scan_fn, state, batches)
+
+    return state, loss, n_correct_per_class, n_per_class
+
+
+# Jitted once at module scope, such that the trace cache persists across epochs: it
+# keys by the static 'n_classes' and the model's apply_fn (static auxiliary data of the
+# TrainState pytree), instead of being discarded with a per-epoch partial object.
+# The incoming training state is donated, such that XLA reuses its parameter and
+# optimizer buffers in place instead of allocating fresh ones every step.
+train_multi_step_jit = jax.jit(
+    train_multi_step, static_argnames="n_classes", donate_argnums=(0,)
+)
+
+
 def test_step(
     state: TrainState,
     batch: Tuple[
@@ -117,11 +168,17 @@ def test_step(
             number of ground-truth items per class ([C]).
     """
 
+    # Retrieve data (with validity mask, if the data loader pads the final batch)
+    x, y, *rest = batch
+    mask = rest[0] if rest else jnp.ones_like(y)  # [N]
+
     def model_loss_fn(
         params: FrozenDict[str, Any], x: jax.Array, y: jax.Array
     ) -> Tuple[jax.Array, Tuple[jax.Array]]:
         """
         Performs model forward pass and evaluates mean loss as a function of model parameters.
+        The top-1 correctness indicator is folded into the auxiliary output, such that it
+        shares the logits with the loss instead of requiring a separate pass.
 
         Args:
             params (FrozenDict[str, Any]): Model parameters ([D], pytree in D).
@@ -131,28 +188,26 @@ def test_step(
         Returns:
             Tuple[jax.Array, Tuple[jax.Array]]:
                 Per-item loss ([N]),
-                model output ([N, C]).
+                per-item correctness indicator ([N]).
         """
 
         logits = state.apply_fn(params, x)  # [N, C]
         loss_unreduced = optax.softmax_cross_entropy_with_integer_labels(logits, y)  # [N]
-        return loss_unreduced, (logits,)  # type: ignore
-
-    # Retrieve data
-    x, y = batch
+        correct = (jnp.argmax(logits, -1) == y).astype(int) * mask  # [N]
+        return loss_unreduced, (correct,)  # type: ignore
 
     # Forward pass
-    loss, (logits,) = model_loss_fn(state.params, x, y)  # [N]; [N, C]
+    loss, (correct,) = model_loss_fn(state.params, x, y)  # [N]; [N]
+    loss = mask * loss  # [N]
 
     # Compute number of correct predictions per class
-    correct = (jnp.argmax(logits, -1) == y).astype(int)  # [N]
     # Add dummy false predictions to account for every class
     y_dummy = jnp.concatenate((y, jnp.arange(n_classes, dtype=int)))  # [N+C]
     correct_dummy = jnp.concatenate((correct, jnp.zeros((n_classes,), dtype=int)))  # [N+C]
     n_correct_per_class = jnp.bincount(y_dummy, correct_dummy, length=n_classes)  # [C]
     n_per_class = jnp.bincount(
         y_dummy,
-        jnp.concatenate((jnp.ones_like(y), jnp.zeros((n_classes,), dtype=int))),
+        jnp.concatenate((mask, jnp.zeros((n_classes,), dtype=int))),
         length=n_classes,
     )  # [C]
 
@@ -160,21 +215,27 @@ def test_step(
         d_loss, _ = jax.jacrev(model_loss_fn, has_aux=True)(
             state.params, x, y
         )  # [N, D], pytree in D
-        N, _ = logits.shape
 
-        # Transform 'd_loss' from pytree representation into vector representation
-        d_loss = jnp.concatenate(
-            [x.reshape(N, -1) for x in tree_util.tree_leaves(d_loss)], axis=1
+        # Transform 'd_loss' from pytree representation into vector representation via a
+        # single per-row ravel instead of a reshape+concatenate over all leaves
+        d_loss = jax.vmap(lambda tree: jax.flatten_util.ravel_pytree(tree)[0])(
+            d_loss
         )  # [N, D]
         return loss, d_loss, n_correct_per_class, n_per_class
     else:
         return loss, n_correct_per_class, n_per_class
 
 
+# Jitted once at module scope, such that the trace cache persists across epochs (cf.
+# 'train_multi_step_jit' above).
+test_step_jit = jax.jit(test_step, static_argnames=("n_classes", "return_grad"))
+
+
 def train_epoch(
     state: TrainState,
     train_dataloader: DataLoader,
     n_steps: int,
+    n_jitted_steps: int,
     no_progress_bar: bool,
     checkpoint_manager: CheckpointManager,
 ) -> Tuple[TrainState, float, float, jax.Array, int]:
@@ -185,6 +246,7 @@ def train_epoch(
         state (TrainState): Current training state.
         train_dataloader (DataLoader): Data loader for model training.
         n_steps (int): Current number of completed training step across epochs.
+        n_jitted_steps (int): Number of training steps jitted together via lax.scan.
         no_progress_bar (bool): Disables progress bar.
         checkpoint_manager (CheckpointManager): Checkpoint manager.
 
@@ -198,10 +260,12 @@ def train_epoch(
     """
 
     n_classes = len(train_dataloader.dataset.classes)  # type: ignore
-    train_step_jit = jax.jit(partial(train_step, n_classes=n_classes))
 
     # Running statistics
-    loss_epoch = []  # Per-item losses per training steps
+    # Preallocated buffer for per-item losses, updated in place on device instead of
+    # keeping one array per training step alive until an end-of-epoch concatenate
+    loss_epoch = jnp.zeros((len(train_dataloader) * train_dataloader.batch_size,))  # type: ignore
+    loss_offset = 0  # Number of per-item losses written to 'loss_epoch'
     n_correct_epoch = 0  # Number of correct predictions across the epoch
     n_correct_per_class_epoch = jnp.zeros((n_classes,), dtype=int)
     n_per_class_epoch = jnp.zeros_like(n_correct_per_class_epoch)
@@ -214,31 +278,68 @@ def train_epoch(
     with tqdm(
         total=len(train_dataloader), desc="Train", disable=no_progress_bar, postfix=pbar_stats
     ) as pbar:
-        # Iterate over dataset for training
-        for batch in train_dataloader:
+        batch_group = []  # Group of up to K equally-sized batches, trained via one jit call
+        last_stats_step = -PBAR_STATS_INTERVAL  # Step of last progress-bar statistics update
+
+        def flush_batch_group() -> None:
+            """
+            Performs training steps for the collected batch group via a single jit call
+            and updates the running statistics.
+            """
+
+            nonlocal state, n_steps, loss_epoch, loss_offset, n_correct_epoch, n_correct_per_class_epoch, n_per_class_epoch, batch_group, last_stats_step
+
             # Checkpointing
             checkpoint_manager.save(n_steps, state, save_kwargs={'save_args': save_args})
-            # Perform training step
-            state, loss, n_correct_per_class, n_per_class = train_step_jit(
+            # Stack batches along a new scan dim and perform training steps
+            batches = jax.tree_map(lambda *xs: jnp.stack(xs), *batch_group)  # [K, N, ...]
+            state, loss, n_correct_per_class, n_per_class = train_multi_step_jit(
                 state,
-                batch,
-            )
+                batches,
+                n_classes=n_classes,
+            )  # [K, N]; [K, C]; [K, C]
+            loss = loss.reshape(-1)  # [K * N]
+            n_correct_per_class = n_correct_per_class.sum(axis=0)  # [C]
+            n_per_class = n_per_class.sum(axis=0)  # [C]
             # Update running statistics
-            loss_epoch.append(loss)
+            loss_epoch = jax.lax.dynamic_update_slice(loss_epoch, loss, (loss_offset,))
+            loss_offset += loss.shape[0]
             n_correct_per_class_epoch = n_correct_per_class_epoch + n_correct_per_class
             n_per_class_epoch = n_per_class_epoch + n_per_class
             n_correct = n_correct_per_class.sum()
             n_correct_epoch += n_correct
-            N = batch[0].shape[0]
-            n_steps += 1
-            # Update progress bar
-            pbar.update()
-            pbar_stats["loss"] = round(float(jnp.mean(loss)), 6)
-            pbar_stats["acc"] = round(n_correct / N, 4)
-            pbar.set_postfix(pbar_stats)
+            n_steps += len(batch_group)
+            # Update progress bar; formatting the statistics syncs with the device, so
+            # only do it every PBAR_STATS_INTERVAL steps
+            pbar.update(len(batch_group))
+            if n_steps - last_stats_step >= PBAR_STATS_INTERVAL:
+                last_stats_step = n_steps
+                pbar_stats["loss"] = round(float(jnp.mean(loss)), 6)
+                pbar_stats["acc"] = round(n_correct / loss.shape[0], 4)
+                pbar.set_postfix(pbar_stats)
+            batch_group = []
+
+        # Iterate over dataset for training
+        for batch in train_dataloader:
+            # Flush incomplete group early if batch sizes differ (final smaller batch),
+            # since lax.scan requires equally-sized batches
+            if batch_group and batch[0].shape[0] != batch_group[0][0].shape[0]:
+                flush_batch_group()
+            # Flush incomplete group early before a checkpointed step, such that
+            # checkpoint_manager.save is invoked with exactly that step value (orbax
+            # silently skips saves at non-qualifying steps)
+            if batch_group and checkpoint_manager.should_save(n_steps + len(batch_group)):
+                flush_batch_group()
+            batch_group.append(batch)
+            if len(batch_group) == n_jitted_steps:
+                flush_batch_group()
+        # Flush final (incomplete) group
+        if batch_group:
+            flush_batch_group()
 
     # Compute final epoch statistics: Epoch loss, epoch accuracy (per class)
-    loss = jnp.mean(jnp.concatenate(loss_epoch)).item()  # [1]
+    # Padded items carry zero loss, so normalize by the number of real items
+    loss = (jnp.sum(loss_epoch) / n_per_class_epoch.sum()).item()  # [1]
     accuracy = float(n_correct_epoch / len(train_dataloader.dataset))  # type: ignore
     accuracy_per_class = n_correct_per_class_epoch / n_per_class_epoch  # type: ignore
 
@@ -266,10 +367,12 @@ def test_epoch(
     """
 
     n_classes = len(test_dataloader.dataset.classes)  # type: ignore
-    test_step_jit = jax.jit(partial(test_step, n_classes=n_classes))
 
     # Running statistics
-    loss_epoch = []  # Per-item losses per test steps
+    # Preallocated buffer for per-item losses, updated in place on device instead of
+    # keeping one array per test step alive until an end-of-epoch concatenate
+    loss_epoch = jnp.zeros((len(test_dataloader) * test_dataloader.batch_size,))  # type: ignore
+    loss_offset = 0  # Number of per-item losses written to 'loss_epoch'
     n_correct_epoch = 0  # Number of correct predictions across the epoch
     n_correct_per_class_epoch = jnp.zeros((n_classes,), dtype=int)
     n_per_class_epoch = jnp.zeros_like(n_correct_per_class_epoch)
@@ -283,24 +386,30 @@ def test_epoch(
         postfix=pbar_stats,
     ) as pbar:
         # Iterate over dataset for testing
-        for batch in test_dataloader:
+        for step_idx, batch in enumerate(test_dataloader):
             # Perform test step
-            loss, n_correct_per_class, n_per_class = test_step_jit(state, batch)
+            loss, n_correct_per_class, n_per_class = test_step_jit(
+                state, batch, n_classes=n_classes
+            )
             # Update running statistics
-            loss_epoch.append(loss)
+            loss_epoch = jax.lax.dynamic_update_slice(loss_epoch, loss, (loss_offset,))
+            loss_offset += loss.shape[0]
             n_correct_per_class_epoch = n_correct_per_class_epoch + n_correct_per_class
             n_per_class_epoch = n_per_class_epoch + n_per_class
             n_correct = n_correct_per_class.sum()
             n_correct_epoch += n_correct
             N = batch[0].shape[0]
-            # Update progress bar
+            # Update progress bar; formatting the statistics syncs with the device, so
+            # only do it every PBAR_STATS_INTERVAL steps
             pbar.update()
-            pbar_stats["loss"] = round(float(jnp.mean(loss)), 6)
-            pbar_stats["acc"] = round(n_correct / N, 4)
-            pbar.set_postfix(pbar_stats)
+            if step_idx % PBAR_STATS_INTERVAL == 0:
+                pbar_stats["loss"] = round(float(jnp.mean(loss)), 6)
+                pbar_stats["acc"] = round(n_correct / N, 4)
+                pbar.set_postfix(pbar_stats)
 
     # Compute final epoch statistics: Epoch loss, epoch accuracy (per class)
-    loss = jnp.mean(jnp.concatenate(loss_epoch)).item()  # [1]
+    # Padded items carry zero loss, so normalize by the number of real items
+    loss = (jnp.sum(loss_epoch) / n_per_class_epoch.sum()).item()  # [1]
     accuracy = float(n_correct_epoch / len(test_dataloader.dataset))  # type: ignore
     accuracy_per_class = n_correct_per_class_epoch / n_per_class_epoch  # type: ignore
 